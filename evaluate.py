@@ -1,59 +1,134 @@
+import contextlib
+import weakref
+
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 
-from utils.dice_score import multiclass_dice_coeff, dice_coeff
-from utils.dice_score import dice_loss
-import torch.nn as nn
+from utils.dice_score import multiclass_dice_coeff_from_labels
+from utils.dice_score import dice_loss, dice_loss_from_logits
+
+
+_dice_loss_from_logits_compiled = torch.compile(dice_loss_from_logits, dynamic=False)
+# captured forward graphs per network, reused across evaluation rounds; all graphs of a network share one
+# memory pool, which stays reserved (also during training) for as long as the network lives
+_forward_graphs = weakref.WeakKeyDictionary()
+
+
+def _capture_forward(net, static_image, pool):
+    # warm up on a side stream, then record the forward pass as a CUDA graph on the input's device
+    device = static_image.device
+    with torch.cuda.device(device):
+        stream = torch.cuda.Stream(device=device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                net(static_image)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=pool):
+            static_pred = net(static_image)
+    return graph, static_pred
+
+
+def _to_device(tensor, device, staging, **kwargs):
+    # move a batch to the device; pageable CPU batches go through a reused pinned buffer so the copy is asynchronous
+    if device.type != 'cuda' or tensor.is_cuda or tensor.is_pinned():
+        return tensor.to(device=device, non_blocking=True, **kwargs)
+
+    with torch.cuda.device(device):
+        key = (tensor.shape, tensor.dtype)
+        if key not in staging:
+            staging[key] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True), torch.cuda.Event()
+        buffer, copied = staging[key]
+        # the previous copy out of the buffer must finish before it is overwritten
+        copied.synchronize()
+        buffer.copy_(tensor)
+        out = buffer.to(device=device, non_blocking=True, **kwargs)
+        copied.record(torch.cuda.current_stream(device))
+    return out
 
 
 @torch.inference_mode()
-def evaluate(net, dataloader, device, amp):
+def evaluate(net, dataloader, device, amp, compute_loss=True, cuda_graph=False):
     net.eval()
     num_val_batches = len(dataloader)
-    dice_score = 0
-    criterion = nn.CrossEntropyLoss() if net.n_classes > 1 else nn.BCEWithLogitsLoss()
-    loss_total = 0
+    dice_scores = []
+    losses = []
+    cuda_graph = cuda_graph and device.type == 'cuda'
+    # feed inputs in the weights' dtype; autocast is only needed for float32 weights
+    dtype = next(net.parameters()).dtype
+    amp = amp and dtype == torch.float32
+    # fuse the softmax and the Dice reductions of the multiclass loss into a single kernel on CUDA
+    multiclass_dice_loss = _dice_loss_from_logits_compiled if device.type == 'cuda' else dice_loss_from_logits
+    staging = {}
+
 
+    # only autocast on CUDA; the autocast cache must be disabled while capturing a CUDA graph
+    if amp and device.type == 'cuda':
+        autocast = torch.autocast(device.type, dtype=torch.bfloat16, cache_enabled=not cuda_graph)
+    else:
+        autocast = contextlib.nullcontext()
 
     # iterate over the validation set
-    with torch.autocast(device.type if device.type != 'mps' else 'cpu', enabled=amp):
+    with autocast:
         for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
             image, mask_true = batch['image'], batch['mask']
 
             # move images and labels to correct device and type
-            image = image.to(device=device, dtype=torch.float32, memory_format=torch.channels_last)
-            mask_true = mask_true.to(device=device, dtype=torch.long)
+            image = _to_device(image, device, staging, dtype=dtype, memory_format=torch.channels_last)
+            mask_true = _to_device(mask_true, device, staging, dtype=torch.long)
 
-            # predict the mask
-            mask_pred = net(image)
+            # predict the mask, replaying the graph captured for this input shape
+            if cuda_graph:
+                if net not in _forward_graphs:
+                    _forward_graphs[net] = torch.cuda.graph_pool_handle(), {}
+                pool, graphs = _forward_graphs[net]
+                key = (image.shape, image.dtype, amp)
+                if key not in graphs:
+                    static_image = image.clone()
+                    graphs[key] = (static_image, *_capture_forward(net, static_image, pool))
+                static_image, graph, static_pred = graphs[key]
+                static_image.copy_(image)
+                with torch.cuda.device(device):
+                    graph.replay()
+                mask_pred = static_pred
+            else:
+                mask_pred = net(image)
+            # keep the loss and Dice computations in float32
+            mask_pred = mask_pred.float()
 
             if net.n_classes == 1:
-                    loss = criterion(mask_pred.squeeze(1), mask_true.float())
-                    loss += dice_loss(F.sigmoid(mask_pred.squeeze(1)), mask_true.float(), multiclass=False)
-                    loss_total += loss
+                assert mask_true.min() >= 0 and mask_true.max() <= 1, 'True mask indices should be in [0, 1]'
+                logits = mask_pred.squeeze(1)
             else:
-                loss = criterion(mask_pred, mask_true)
-                loss += dice_loss(
-                    F.softmax(mask_pred, dim=1).float(),
-                    F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float(),
-                    multiclass=True
-                )
-                loss_total += loss
+                assert mask_true.min() >= 0 and mask_true.max() < net.n_classes, 'True mask indices should be in [0, n_classes['
+
+            if compute_loss:
+                if net.n_classes == 1:
+                    mask_true_f = mask_true.float()
+                    loss = F.binary_cross_entropy_with_logits(logits, mask_true_f)
+                    loss += dice_loss(torch.sigmoid(logits), mask_true_f, multiclass=False)
+                    losses.append(loss.detach())
+                else:
+                    loss = F.cross_entropy(mask_pred, mask_true)
+                    loss += multiclass_dice_loss(mask_pred, mask_true)
+                    losses.append(loss.detach())
 
 
             if net.n_classes == 1:
-                assert mask_true.min() >= 0 and mask_true.max() <= 1, 'True mask indices should be in [0, 1]'
-                mask_pred = (F.sigmoid(mask_pred) > 0.5).float()
-                # compute the Dice score
-                dice_score += dice_coeff(mask_pred, mask_true, reduce_batch_first=False)
+                # compute the foreground Dice score from the thresholded labels (sigmoid > 0.5 <=> logits > 0)
+                pred_labels = (logits > 0).long()
+                dice_scores.append(multiclass_dice_coeff_from_labels(pred_labels, mask_true, 2, ignore_background=True))
             else:
-                assert mask_true.min() >= 0 and mask_true.max() < net.n_classes, 'True mask indices should be in [0, n_classes['
-                # convert to one-hot format
-                mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
-                # compute the Dice score, ignoring background
-                dice_score += multiclass_dice_coeff(mask_pred[:, 1:], mask_true[:, 1:], reduce_batch_first=False)
+                # compute the Dice score from the predicted labels, ignoring background
+                pred_labels = mask_pred.argmax(dim=1)
+                dice_scores.append(multiclass_dice_coeff_from_labels(pred_labels, mask_true, net.n_classes,
+                                                                     ignore_background=True))
 
     net.train()
-    return dice_score / max(num_val_batches, 1), loss_total / max(num_val_batches, 1)
+    # average the per-batch results
+    dice_score = float(torch.stack(dice_scores).mean()) if dice_scores else 0.
+    loss = float(torch.stack(losses).mean()) if losses else 0.
+    return dice_score, loss
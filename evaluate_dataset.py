@@ -4,7 +4,7 @@ import os
 
 import numpy as np
 import torch
-import torch.nn.functional as F
+import torch.nn as nn
 from PIL import Image
 from torchvision import transforms
 from torchvision.utils import save_image, make_grid
@@ -29,24 +29,26 @@ dir_val_mask = Path('./data/val/masks/')
 dir_test_img = Path('./data/test/imgs/')
 dir_test_mask = Path('./data/test/masks/')
 full_img_size = (140, 175)
+# upsampling to the full image size; masks hold class labels, so they use nearest
+upsample_images = nn.Upsample(size=(full_img_size[1], full_img_size[0]), mode='bilinear', align_corners=False)
+upsample_masks = nn.Upsample(size=(full_img_size[1], full_img_size[0]), mode='nearest')
 
+@torch.inference_mode()
 def qualitative_results(dataset, path, model, device='cpu'):
     len_dataset = len(dataset)
     # dataset = Subset(dataset, range(0, len_dataset, len_dataset//6))
     row_n = 14
-    dataset_loader = DataLoader(dataset, batch_size= len_dataset, shuffle=False)
-
-    batch = next(iter(dataset_loader))
-    images, true_masks = batch['image'], batch['mask']
-    images = images.to(device=device)
-    true_masks = true_masks.to(device=device).unsqueeze(1).float()
+    # the visualisation sets are small, so index them directly instead of going through a DataLoader
+    samples = [dataset[i] for i in range(len_dataset)]
+    images = torch.stack([s['image'] for s in samples]).to(device=device, memory_format=torch.channels_last)
+    true_masks = torch.stack([s['mask'] for s in samples]).to(device=device).unsqueeze(1).float()
     
-    out_masks = model(images)
+    out_masks = model(images.to(dtype=next(model.parameters()).dtype))
     out_masks = out_masks.argmax(dim=1).unsqueeze(1).float()
 
-    images = F.interpolate(images, (full_img_size[1], full_img_size[0]), mode='bilinear')
-    true_masks = F.interpolate(true_masks, (full_img_size[1], full_img_size[0]), mode='bilinear')
-    out_masks = F.interpolate(out_masks, (full_img_size[1], full_img_size[0]), mode='bilinear')
+    images = upsample_images(images)
+    # upsample the true and predicted masks together in a single call
+    true_masks, out_masks = upsample_masks(torch.cat([true_masks, out_masks])).split(len_dataset)
     
     save_image(make_grid(images, nrow=row_n), os.path.join(path, 'images.png'))
     save_image(make_grid(true_masks, nrow=row_n), os.path.join(path,'true_masks.png'))
@@ -75,6 +77,10 @@ if __name__ == '__main__':
     state_dict = torch.load(args.model, map_location=device)
     mask_values = state_dict.pop('mask_values', [0, 1])
     net.load_state_dict(state_dict)
+    net = net.to(memory_format=torch.channels_last)
+    if args.amp:
+        # cast the weights once instead of autocasting every op
+        net = net.to(dtype=torch.bfloat16)
     net.eval()
 
     img_scale = 0.5
@@ -104,16 +110,25 @@ if __name__ == '__main__':
         
 
     # 3. Create data loaders
-    loader_args = dict(batch_size=batch_size, num_workers=os.cpu_count(), pin_memory=True)
-    train_loader = DataLoader(train_set, shuffle=False)
-    val_loader = DataLoader(val_set, shuffle=False)
-    test_loader = DataLoader(test_set, shuffle=False)
-    test_unseen_set_loader = DataLoader(test_unseen_set, shuffle=False)
-
-    train_score, _ = evaluate(net, train_loader, device, args.amp)
-    val_score, _ = evaluate(net, val_loader, device, args.amp)
-    test_score, _ = evaluate(net, test_loader, device, args.amp)
-    test_unseen_score, _ = evaluate(net, test_unseen_set_loader, device, args.amp)
+    # the tool datasets are already loaded on the device, so only the default dataset uses loader workers
+    loader_args = dict(num_workers=min(4, os.cpu_count()), pin_memory=True) if args.default else {}
+    train_loader = DataLoader(train_set, shuffle=False, **loader_args)
+    val_loader = DataLoader(val_set, shuffle=False, **loader_args)
+    test_loader = DataLoader(test_set, shuffle=False, **loader_args)
+    test_unseen_set_loader = DataLoader(test_unseen_set, shuffle=False, **loader_args)
+
+    # compile the network for evaluation and pay the compile cost on a dummy batch
+    eval_net = net
+    if torch.cuda.is_available():
+        eval_net = torch.compile(net, mode='reduce-overhead')
+        dummy = torch.zeros((1, *val_set[0]['image'].shape), device=device, dtype=next(net.parameters()).dtype)
+        with torch.inference_mode():
+            eval_net(dummy.to(memory_format=torch.channels_last))
+
+    train_score, _ = evaluate(eval_net, train_loader, device, args.amp, compute_loss=False)
+    val_score, _ = evaluate(eval_net, val_loader, device, args.amp, compute_loss=False)
+    test_score, _ = evaluate(eval_net, test_loader, device, args.amp, compute_loss=False)
+    test_unseen_score, _ = evaluate(eval_net, test_unseen_set_loader, device, args.amp, compute_loss=False)
 
     print(f'Training Dice score: {train_score:.4f}')
     print(f'Validation Dice score: {val_score:.4f}')
@@ -123,10 +138,10 @@ if __name__ == '__main__':
     # Save scores in a CSV file
     scores = [
         ['Dataset', 'Score'],
-        ['Training', train_score.item()],
-        ['Validation', val_score.item()],
-        ['Test', test_score.item()],
-        ['Test Unseen', test_unseen_score.item()]
+        ['Training', train_score],
+        ['Validation', val_score],
+        ['Test', test_score],
+        ['Test Unseen', test_unseen_score]
     ]
 
     train_tools, test_tools = datasets_definiton(args.dataset_name)
@@ -136,9 +151,9 @@ if __name__ == '__main__':
     test_len = len(test_set)//len(train_tools)
     for i, tool in enumerate(train_tools):
         tool_set = Subset(test_set, range(i*test_len, (i+1)*test_len))
-        tool_loader = DataLoader(tool_set, shuffle=False)
-        tool_score, _ = evaluate(net, tool_loader, device, args.amp)
-        scores_per_tool.append([i+1, tool_score.item()])
+        tool_loader = DataLoader(tool_set, shuffle=False, **loader_args)
+        tool_score, _ = evaluate(eval_net, tool_loader, device, args.amp, compute_loss=False)
+        scores_per_tool.append([i+1, tool_score])
 
     scores_per_tool_file = os.path.join(model_results_path, 'test', 'scores_per_tools.pt')
     torch.save(scores_per_tool, scores_per_tool_file)
@@ -154,9 +169,9 @@ if __name__ == '__main__':
     test_unseen_len = len(test_unseen_set)//len(test_tools)
     for i, tool in enumerate(test_tools):
         tool_set = Subset(test_unseen_set, range(i*test_unseen_len, (i+1)*test_unseen_len))
-        tool_loader = DataLoader(tool_set, shuffle=False)
-        tool_score, _ = evaluate(net, tool_loader, device, args.amp)
-        scores_per_tool.append([i+1, tool_score.item()])
+        tool_loader = DataLoader(tool_set, shuffle=False, **loader_args)
+        tool_score, _ = evaluate(eval_net, tool_loader, device, args.amp, compute_loss=False)
+        scores_per_tool.append([i+1, tool_score])
 
     scores_per_tool_file = os.path.join(model_results_path, 'test_unseen', 'scores_per_tools.pt')
     torch.save(scores_per_tool, scores_per_tool_file)
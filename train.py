@@ -163,7 +163,7 @@ def train_model(
                             if not (torch.isinf(value.grad) | torch.isnan(value.grad)).any():
                                 histograms['Gradients/' + tag] = wandb.Histogram(value.grad.data.cpu())
 
-                        val_score, _ = evaluate(model, val_loader, device, amp)
+                        val_score, _ = evaluate(model, val_loader, device, amp, compute_loss=False, cuda_graph=True)
                         scheduler.step(val_score)
 
                         logging.info('Validation Dice score: {}'.format(val_score))
@@ -152,10 +152,10 @@ def train_model(
                             if not (torch.isinf(value.grad) | torch.isnan(value.grad)).any():
                                 histograms['Gradients/' + tag] = wandb.Histogram(value.grad.data.cpu())
 
-                        train_score, train_loss = evaluate(model, train_loader, device, amp)
-                        val_score, val_loss = evaluate(model, val_loader, device, amp)
-                        test_score, test_loss = evaluate(model, test_loader, device, amp)
-                        test_unseen_score, test_unseen_loss = evaluate(model, test_unseen_set_loader, device, amp)
+                        train_score, train_loss = evaluate(model, train_loader, device, amp, cuda_graph=True)
+                        val_score, val_loss = evaluate(model, val_loader, device, amp, cuda_graph=True)
+                        test_score, test_loss = evaluate(model, test_loader, device, amp, cuda_graph=True)
+                        test_unseen_score, test_unseen_loss = evaluate(model, test_unseen_set_loader, device, amp, cuda_graph=True)
                         scheduler.step(val_score)
 
                         logging.info('Validation Dice score: {}'.format(val_score))
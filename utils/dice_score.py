@@ -22,7 +22,31 @@ def multiclass_dice_coeff(input: Tensor, target: Tensor, reduce_batch_first: boo
     return dice_coeff(input.flatten(0, 1), target.flatten(0, 1), reduce_batch_first, epsilon)
 
 
+def multiclass_dice_coeff_from_labels(input: Tensor, target: Tensor, n_classes: int, ignore_background: bool = False,
+                                      epsilon: float = 1e-6):
+    # Same as multiclass_dice_coeff on one-hot masks, computed from N x H x W label masks via per-sample confusion matrices
+    n = input.size(0)
+    sample = torch.arange(n, device=input.device).view(n, 1)
+    flat = (sample * n_classes + input.flatten(1)) * n_classes + target.flatten(1)
+    cm = torch.bincount(flat.flatten(), minlength=n * n_classes ** 2).view(n, n_classes, n_classes).float()
+
+    inter = 2 * cm.diagonal(dim1=1, dim2=2)
+    sets_sum = cm.sum(dim=2) + cm.sum(dim=1)
+    sets_sum = torch.where(sets_sum == 0, inter, sets_sum)
+
+    dice = (inter + epsilon) / (sets_sum + epsilon)
+    return dice[:, 1:].mean() if ignore_background else dice.mean()
+
+
 def dice_loss(input: Tensor, target: Tensor, multiclass: bool = False):
     # Dice loss (objective to minimize) between 0 and 1
     fn = multiclass_dice_coeff if multiclass else dice_coeff
     return 1 - fn(input, target, reduce_batch_first=True)
+
+
+def dice_loss_from_logits(input: Tensor, target: Tensor, epsilon: float = 1e-6):
+    # Same as the multiclass dice_loss on softmax(input) and one-hot target, without materializing the one-hot target
+    probs = input.softmax(dim=1)
+    inter = 2 * probs.gather(1, target.unsqueeze(1)).sum()
+    sets_sum = probs.sum() + target.numel()
+    return 1 - (inter + epsilon) / (sets_sum + epsilon)